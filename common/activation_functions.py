@@ -6,26 +6,33 @@ def step_function(X):
     """
     return np.array(X > 0, dtype=np.int)
 
-def sigmoid(X):
+def sigmoid(X, out=None):
     """
-    シグモイド関数を計算
+    シグモイド関数を計算 (outを指定すると、確保済みの配列に結果を書き込む)
     """
-    return 1 / (1 + np.exp(-X))
+    if out is None:
+        return 1 / (1 + np.exp(-X))
+    # 一時配列を作らないよう、outの上で順番に計算
+    np.negative(X, out=out)
+    np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
 
-def relu(X):
+def relu(X, out=None):
     """
-    ReLU関数を計算
+    ReLU関数を計算 (outを指定すると、確保済みの配列に結果を書き込む)
     """
-    return np.maximum(0, X)
+    return np.maximum(0, X, out=out)
 
-def softmax(A):
+def softmax(A, out=None):
     """
-    ソフトマックス関数を計算
+    ソフトマックス関数を計算 (outを指定すると、確保済みの配列に結果を書き込む)
     """
     C = np.max(A, axis=-1, keepdims=True)  # バッチ処理のため、横方向に最大値計算＆次元を維持
-    exp_A = np.exp(A - C)   # オーバーフロー対策
+    exp_A = np.subtract(A, C, out=out)  # オーバーフロー対策
+    np.exp(exp_A, out=exp_A)
     sum_exp_A = np.sum(exp_A, axis=-1, keepdims=True)  # バッチ処理のため、横方向に合計計算＆次元を維持
-    Y = exp_A / sum_exp_A
+    Y = np.divide(exp_A, sum_exp_A, out=exp_A)
     return Y
 
 def identity(X):
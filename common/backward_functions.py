@@ -1,11 +1,12 @@
 import numpy as np
 
-def softmax_loss_backward(Y, T):
+def softmax_loss_backward(Y, T, out=None):
     """
     Softmax-with-Lossレイヤの逆伝播
     """
     batch_size = T.shape[0]
-    dA = (Y - T) / batch_size
+    dA = np.subtract(Y, T, out=out)
+    dA /= batch_size
     return dA
 
 def affine_backward_bias(dA):
@@ -29,18 +30,36 @@ def affine_backward_zprev(dA, W):
     dZ_prev = np.dot(dA, W.T)  # dAと重みパラメータWの転置の積
     return dZ_prev
 
-def relu_backward(dZ, A):
+def relu_backward(dZ, A, out=None):
     """
-    ReLUレイヤの逆伝播
+    ReLUレイヤの逆伝播 (outを指定すると、確保済みの配列に結果を書き込む)
     """
     mask = (A <= 0)  # a ≦ 0を判定する行列
-    dA = dZ.copy()  # dZを一旦入力
+    if out is None:
+        dA = dZ.copy()  # dZを一旦入力
+    else:
+        dA = out
+        dA[...] = dZ  # 確保済みの配列にdZを一旦入力
     dA[mask] = 0  # a ≦ 0の成分のみを0に置き換え
     return dA
 
-def sigmoid_backward(dZ, Z):
+def sigmoid_backward(dZ, Z, out=None):
     """
-    Sigmoidレイヤの逆伝播
+    Sigmoidレイヤの逆伝播 (outを指定すると、確保済みの配列に結果を書き込む)
     """
-    dA = Z * (1.0 - Z) * dZ  # 各成分の掛け合わせ（アダマール積）でdAを計算
+    # 各成分の掛け合わせ（アダマール積）でdAを計算
+    dA = np.subtract(1.0, Z, out=out)
+    dA *= Z
+    dA *= dZ
     return dA
+
+def affine_backward(dA, Z_prev, W=None, dW_out=None, db_out=None, dZ_prev_out=None):
+    """
+    Affineレイヤの逆伝播 (dW, db, dZ_prevを1回の呼び出しでまとめて計算)
+    (dW_out, db_out, dZ_prev_outを指定すると、確保済みの配列に結果を書き込む)
+    """
+    dW = np.dot(Z_prev.T, dA, out=dW_out)  # 重みパラメータWの偏微分
+    db = np.sum(dA, axis=0, out=db_out)  # バイアスパラメータbの偏微分
+    # 前層出力Z_prevの偏微分 (初層のように不要な場合はW=Noneとして計算を省略)
+    dZ_prev = np.dot(dA, W.T, out=dZ_prev_out) if W is not None else None
+    return dW, db, dZ_prev
@@ -1,15 +1,16 @@
 import numpy as np
 from common.activation_functions import softmax, identity, sigmoid, relu, step_function
 
-def forward_middle(Z_prev, W, b, activation_function='sigmoid', output_A=False):
+def forward_middle(Z_prev, W, b, activation_function='sigmoid', output_A=False,
+                   A_out=None, Z_out=None):
     """
-    中間層の順伝播計算
+    中間層の順伝播計算 (A_out, Z_outを指定すると、確保済みの配列にA, Zを書き込む)
     """
-    A = np.dot(Z_prev, W) + b
+    A = np.add(np.dot(Z_prev, W, out=A_out), b, out=A_out)
     if activation_function == 'sigmoid':
-        Z = sigmoid(A)
+        Z = sigmoid(A, out=Z_out)
     elif activation_function == 'relu':
-        Z = relu(A)
+        Z = relu(A, out=Z_out)
     elif activation_function == 'step':
         Z = step_function(A)
     else:
@@ -21,14 +22,31 @@ def forward_middle(Z_prev, W, b, activation_function='sigmoid', output_A=False):
     else:
         return Z
 
-def forward_last_classification(Z_prev, W, b):
+def forward_middle_fast(Z_prev, W, b, activation, out=None):
     """
-    出力層の順伝播計算(分類)
+    中間層の順伝播計算 (活性化関数を文字列ではなく関数で受け取り、行列積の結果の配列上でバイアスの加算と活性化関数をin-placeで計算)
+    (outを指定すると、確保済みの配列に結果を書き込む)
     """
-    A = np.dot(Z_prev, W) + b
-    Y = softmax(A)
+    A = np.dot(Z_prev, W, out=out)
+    A += b
+    return activation(A, out=A)
+
+def forward_last_classification(Z_prev, W, b, out=None):
+    """
+    出力層の順伝播計算(分類) (outを指定すると、確保済みの配列に結果を書き込む)
+    """
+    A = np.add(np.dot(Z_prev, W, out=out), b, out=out)
+    Y = softmax(A, out=A)
     return Y
 
+def forward_last_logits(Z_prev, W, b, out=None):
+    """
+    出力層の順伝播計算 (ソフトマックス関数適用前のロジットを出力。outを指定すると、確保済みの配列に結果を書き込む)
+    """
+    A = np.dot(Z_prev, W, out=out)
+    A += b
+    return A
+
 def forward_last_regression(z_prev, W, b):
     """
     出力層の順伝播計算(回帰)
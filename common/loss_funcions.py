@@ -4,14 +4,33 @@ def cross_entropy_error(Y, T):
     """
     交差エントロピー誤差を計算
     """
-    # 交差エントロピー誤差を計算して返す
+    # 交差エントロピー誤差を計算して返す (微小値deltaを足してlog(0)による発散を防ぐ)
+    delta = 1e-7
+    # 3次元以上 (複数ネットワークの出力を先頭の軸に並べた配列)の場合は、末尾2軸(データ, クラス)ごとに計算
+    if Y.ndim > 2:
+        batch_size = Y.shape[-2]
+        return -np.sum(T * np.log(Y + delta), axis=(-2, -1)) / batch_size
     batch_size = Y.shape[0]
-    return -np.sum(T * np.log(Y)) / batch_size
+    return -np.sum(T * np.log(Y + delta)) / batch_size
+
+def cross_entropy_from_logits(A, T_label):
+    """
+    ソフトマックス関数適用前のロジットAと正解クラスのインデックスから、交差エントロピー誤差を計算
+    (log-sum-expで計算するため、ソフトマックス関数の出力を経由せずにlog(0)による発散も起こらない)
+    """
+    batch_size = A.shape[0]
+    C = np.max(A, axis=1, keepdims=True)  # オーバーフロー対策
+    log_sum_exp = C[:, 0] + np.log(np.sum(np.exp(A - C), axis=1))
+    return (np.sum(log_sum_exp) - np.sum(A[np.arange(batch_size), T_label])) / batch_size
 
 def squared_error(Y, T):
     """
     2乗和誤差を計算
     """
     # 2乗和誤差を計算して返す
+    # 3次元以上 (複数ネットワークの出力を先頭の軸に並べた配列)の場合は、末尾2軸(データ, クラス)ごとに計算
+    if Y.ndim > 2:
+        batch_size = Y.shape[-2]
+        return 1.0/2.0 * np.sum(np.square(Y - T), axis=(-2, -1)) / batch_size
     batch_size = Y.shape[0]
     return 1.0/2.0 * np.sum(np.square(Y - T)) / batch_size
\ No newline at end of file
@@ -0,0 +1,112 @@
+import numpy as np
+
+class EpochSampler:
+    """
+    ミニバッチのサンプリング (エポックごとに全データをシャッフルし、先頭から順にミニバッチを取り出す)
+    """
+    def __init__(self, rng):
+        """
+        サンプラーの初期化
+
+        Parameters
+        ----------
+        rng : numpy.random.Generator
+            シャッフルに使用する乱数生成器
+        """
+        self.reset(rng)
+
+    def reset(self, rng=None):
+        """
+        シャッフル済みデータ等の状態を破棄 (rngを指定すると乱数生成器も置き換える)
+        """
+        if rng is not None:
+            self.rng = rng  # 乱数生成器
+        self.executor = None  # 次エポックのシャッフルを先読みするスレッド (fit実行中のみ外部から設定)
+        self._perm = None  # エポックごとにシャッフルしたデータのタプル (ミニバッチはここからスライスで取り出す)
+        self._pos = 0  # 次のミニバッチの先頭位置
+        self._spare = None  # 使い終わったエポックの配列のタプル (次エポックのシャッフル結果の書き込み先として再利用)
+        self._batch_buf = None  # エポックの境界をまたぐミニバッチの格納先
+        self._prefetch = None  # 先読み中の次エポックのシャッフル結果
+
+    def sample(self, arrays, batch_size):
+        """
+        ミニバッチの取得
+
+        Parameters
+        ----------
+        arrays : Tuple[np.ndarray, ...]
+            先頭の軸がデータ方向の配列のタプル (各配列から同じデータのミニバッチを取り出す)
+        batch_size : int
+            ミニバッチのデータ数
+
+        Returns
+        -------
+        Tuple[np.ndarray, ...]
+            arraysの各配列から取り出したミニバッチのタプル (形状：(batch_size, ...))
+        """
+        train_size = arrays[0].shape[0]  # サンプリング前のデータ数
+        # バッチサイズがデータ数より大きい場合は、1エポックに収まらないため復元抽出でサンプリング
+        if batch_size > train_size:
+            batch_mask = self.rng.integers(train_size, size=batch_size)
+            return tuple(a[batch_mask] for a in arrays)
+        # 初回やデータが変わった場合は、先読み結果を破棄して新しいエポックを開始
+        if self._perm is None or len(self._perm) != len(arrays) \
+                or any(p.shape != a.shape for p, a in zip(self._perm, arrays)):
+            self._prefetch = None
+            self._start_epoch(arrays)
+        # 1エポック分のデータを使い切った場合は、次のエポックを開始
+        elif self._pos >= train_size:
+            self._start_epoch(arrays)
+        pos = self._pos
+        # シャッフル済みのデータを先頭から順にスライス (コピーを伴わないビューとして取り出す)
+        if pos + batch_size <= train_size:
+            self._pos = pos + batch_size
+            return tuple(p[pos:pos+batch_size] for p in self._perm)
+        # エポックの末尾に残ったデータがバッチサイズに満たない場合は、次のエポックの先頭とつなげてミニバッチを作成
+        # (末尾のデータを捨てないため、1エポックで全データを1回ずつ使用する)
+        n_tail = train_size - pos  # 現エポックから取り出すデータ数
+        if self._batch_buf is None or len(self._batch_buf) != len(arrays) \
+                or any(b.shape != (batch_size,) + a.shape[1:] or b.dtype != a.dtype
+                       for b, a in zip(self._batch_buf, arrays)):
+            self._batch_buf = tuple(np.empty_like(a, shape=(batch_size,) + a.shape[1:]) for a in arrays)
+        for batch, perm in zip(self._batch_buf, self._perm):
+            batch[:n_tail] = perm[pos:]
+        self._start_epoch(arrays)  # 現エポックの配列は、先に末尾をコピーしてから次エポックの書き込み先として再利用
+        for batch, perm in zip(self._batch_buf, self._perm):
+            batch[n_tail:] = perm[:batch_size-n_tail]
+        self._pos = batch_size - n_tail
+        return self._batch_buf
+
+    def _start_epoch(self, arrays):
+        """
+        全データをシャッフルし直して次のエポックを開始
+        """
+        train_size = arrays[0].shape[0]
+        # 先読み済みの次エポックがあれば受け取り、なければその場でシャッフル
+        if self._prefetch is not None:
+            perm_arrays = self._prefetch.result()
+            self._prefetch = None
+        else:
+            perm = self.rng.permutation(train_size)  # 非復元抽出 (1エポックで全データを1回ずつ使用)
+            perm_arrays = self._shuffle(arrays, perm, self._spare)
+        # 使い終わったエポックの配列は、次エポックの書き込み先として再利用 (ダブルバッファ)
+        self._spare = self._perm
+        self._perm = perm_arrays
+        self._pos = 0
+        # fit実行中は、次エポックのシャッフルをバックグラウンドで先読み
+        # (np.takeの実行中はGILが解放されるため、学習の計算と並行して実行される)
+        if self.executor is not None:
+            perm = self.rng.permutation(train_size)  # 乱数生成はメインスレッドで実施 (乱数列を同期実行時と一致させる)
+            self._prefetch = self.executor.submit(self._shuffle, arrays, perm, self._spare)
+
+    @staticmethod
+    def _shuffle(arrays, perm, out=None):
+        """
+        全データをpermの順に並べ替える (outを指定すると、確保済みの配列に結果を書き込む)
+        """
+        # 形状や型が一致しない配列には書き込まず、新たに確保
+        if out is None or len(out) != len(arrays) \
+                or any(o.shape != a.shape or o.dtype != a.dtype for o, a in zip(out, arrays)):
+            out = (None,) * len(arrays)
+        # インデックスは必ず範囲内なので、出力の一時バッファを挟まないmode='clip'を指定
+        return tuple(np.take(a, perm, axis=0, out=o, mode='clip') for a, o in zip(arrays, out))
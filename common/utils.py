@@ -16,6 +16,14 @@ def calc_weight_init_std(prev_node_num, weight_init_std, activation_function):
     else:
         return weight_init_std
 
+def make_rng(random_state=None):
+    """
+    乱数生成器を作成 (random_state=Noneの場合は、np.random.seedで設定したグローバルな乱数からシードを取得して再現性を保つ)
+    """
+    if random_state is None:
+        random_state = np.random.randint(np.iinfo(np.int32).max)
+    return np.random.default_rng(random_state)
+
 def flatten(input_data):
     """
     画像(2次元以上)を1次元配列に変換
@@ -1,12 +1,14 @@
 import numpy as np
 from common.forward_functions import forward_middle, forward_last_classification
-from common.backward_functions import softmax_loss_backward, affine_backward_bias, affine_backward_weight, affine_backward_zprev, relu_backward, sigmoid_backward
+from common.backward_functions import softmax_loss_backward, affine_backward, relu_backward, sigmoid_backward
 from common.utils import calc_weight_init_std
 
 class Dense():
     """
     中間層の全結合層 (Affineレイヤ+活性化関数レイヤ)
     """
+    supports_gpu = True  # パラメータをCuPyの配列に置き換えればGPU上で計算可能 (内部でnumpyの配列を生成しない)
+
     def __init__(self, units=32, activation_function='relu', 
                  weight_decay=0, weight_init_std='auto',
                  input_shape=None):
@@ -45,36 +47,60 @@ class Dense():
         # 層出力データの形状を計算
         self._calc_output_shape()
         # パラメータ初期化(重み+バイアス)
+        # (メモリ転送量削減のためfloat32で保持)
         self.params={}
-        self.params['W'] = calc_weight_init_std(self.input_shape[-1], self.weight_init_std, self.activation_function) * \
-                            np.random.randn(self.input_shape[-1], self.units)
-        self.params['b'] = np.zeros(self.units)
+        self.params['W'] = (calc_weight_init_std(self.input_shape[-1], self.weight_init_std, self.activation_function) * \
+                            np.random.randn(self.input_shape[-1], self.units)).astype(np.float32)
+        self.params['b'] = np.zeros(self.units, dtype=np.float32)
+        # 中間結果のバッファはinitialize_buffers()で確保
+        self.buffers = None
+
+    def initialize_buffers(self, batch_size):
+        """順伝播・逆伝播の中間結果と勾配を格納するバッファを確保 (学習中は毎イテレーション使い回す)"""
+        # パラメータと同じ型・デバイス(CPU/GPU)で確保するため、empty_likeで形状のみ指定
+        W = self.params['W']
+        self.buffers = {
+            'Z': np.empty_like(W, shape=(batch_size, self.units)),  # Affineレイヤ出力および活性化関数レイヤ出力 (活性化関数はin-placeで計算)
+            'dA': np.empty_like(W, shape=(batch_size, self.units)),  # Affineレイヤ出力の偏微分
+            'dZ_prev': np.empty_like(W, shape=(batch_size, self.input_shape[-1])),  # 前層出力の偏微分
+            'dW': np.empty_like(self.params['W']),  # 重みパラメータの勾配
+            'db': np.empty_like(self.params['b'])  # バイアスパラメータの勾配
+        }
+
+    def _buffers_for(self, X):
+        """入力のデータ数と型が確保済みバッファと一致するときのみバッファを返す (一致しなければ空の辞書)"""
+        if self.buffers is not None and X.shape[0] == self.buffers['Z'].shape[0] \
+                and X.dtype == self.buffers['Z'].dtype:
+            return self.buffers
+        return {}
 
     def forward(self, Z_prev, train_flg=None):
         """順伝播"""
         self.Z_prev = Z_prev  # 入力を保持 (逆伝播で使用)
-        # 順伝播を計算(Affineレイヤ出力A、活性化関数レイヤ出力Zはメンバ変数に保持)
-        self.Z, self.A = forward_middle(Z_prev, self.params['W'], self.params['b'], 
-                activation_function=self.activation_function, output_A=True)
-        return self.Z
+        Z_out = self._buffers_for(Z_prev).get('Z')
+        # 順伝播を計算 (活性化関数はAffineレイヤ出力Aの配列上でin-placeで計算し、Aは保持しない)
+        Z = forward_middle(Z_prev, self.params['W'], self.params['b'],
+                activation_function=self.activation_function, A_out=Z_out, Z_out=Z_out)
+        self.Z = Z  # 活性化関数レイヤ出力Zはメンバ変数に保持 (逆伝播で使用)
+        return Z
 
     def backward(self, dZ):
         """逆伝播"""
-        # 勾配保持用
-        self.grads={}
-        # Reluレイヤ
+        buffers = self._buffers_for(dZ)
+        Z = self.Z  # 活性化関数レイヤ出力Z
+        # Reluレイヤ (a ≦ 0とz ≦ 0は同値なので、Affineレイヤ出力Aの代わりに活性化関数レイヤ出力Zを入力)
         if self.activation_function == 'relu':
-            dA = relu_backward(dZ, self.A)  # (Affineレイヤ出力Aを入力)
+            dA = relu_backward(dZ, Z, out=buffers.get('dA'))
         # Sigmoidレイヤ
         if self.activation_function == 'sigmoid':
-            dA = sigmoid_backward(dZ, self.Z)  # (活性化関数レイヤ出力Zを入力)
-        # Affineレイヤ
-        db = affine_backward_bias(dA)  # バイアスパラメータbの偏微分
-        dW = affine_backward_weight(dA, self.Z_prev)  # 重みパラメータZの偏微分 (前層出力Z_prevを入力)
-        dZ_prev = affine_backward_zprev(dA, self.params['W'])  # 前層出力dZ_prevの偏微分 (重みパラメータWを入力)
+            dA = sigmoid_backward(dZ, Z, out=buffers.get('dA'))  # (活性化関数レイヤ出力Zを入力)
+        # Affineレイヤ (重みW、バイアスb、前層出力Z_prevの偏微分をまとめて計算)
+        dW, db, dZ_prev = affine_backward(dA, self.Z_prev, self.params['W'],
+                dW_out=buffers.get('dW'), db_out=buffers.get('db'), dZ_prev_out=buffers.get('dZ_prev'))
+        if self.weight_decay:
+            dW += self.weight_decay * self.params['W']  # Weight decay分を勾配に足す
         # 計算した偏微分(勾配)を保持
-        self.grads['b'] = db
-        self.grads['W'] = dW + self.weight_decay * self.params['W']  # Weight decay分を勾配に足す
+        self.grads = {'b': db, 'W': dW}
         # 前層出力の偏微分(勾配)dZ_prevを出力
         return dZ_prev
 
@@ -104,22 +130,23 @@ class DenseOutput(Dense):
     def forward(self, Z_prev, train_flg=None):
         """順伝播"""
         self.Z_prev = Z_prev  # 入力を保持 (逆伝播で使用)
+        buffers = self._buffers_for(Z_prev)
         # 順伝播を計算(Affineレイヤ出力A、活性化関数レイヤ出力Zはメンバ変数に保持)
-        self.Z = forward_last_classification(Z_prev, self.params['W'], self.params['b'])
+        self.Z = forward_last_classification(Z_prev, self.params['W'], self.params['b'],
+                                             out=buffers.get('Z'))
         return self.Z
 
     def backward(self, Y, T):
         """逆伝播"""
-        # 勾配保持用
-        self.grads={}
+        buffers = self._buffers_for(Y)
         # Softmax-with-Lossレイヤ
-        dA = softmax_loss_backward(Y, T)
-        # Affineレイヤ
-        db = affine_backward_bias(dA)  # バイアスパラメータbの偏微分
-        dW = affine_backward_weight(dA, self.Z_prev)  # 重みパラメータZの偏微分 (前層出力Z_prevを入力)
-        dZ_prev = affine_backward_zprev(dA, self.params['W'])  # 前層出力dZ_prevの偏微分 (重みパラメータWを入力)
+        dA = softmax_loss_backward(Y, T, out=buffers.get('dA'))
+        # Affineレイヤ (重みW、バイアスb、前層出力Z_prevの偏微分をまとめて計算)
+        dW, db, dZ_prev = affine_backward(dA, self.Z_prev, self.params['W'],
+                dW_out=buffers.get('dW'), db_out=buffers.get('db'), dZ_prev_out=buffers.get('dZ_prev'))
+        if self.weight_decay:
+            dW += self.weight_decay * self.params['W']  # Weight decay分を勾配に足す
         # 計算した偏微分(勾配)を保持
-        self.grads['b'] = db
-        self.grads['W'] = dW + self.weight_decay * self.params['W']  # Weight decay分を勾配に足す
+        self.grads = {'b': db, 'W': dW}
         # 前層出力の偏微分(勾配)dZ_prevを出力
         return dZ_prev
\ No newline at end of file
@@ -1,9 +1,13 @@
 import numpy as np
 from typing import Dict, List, Tuple
-from sklearn.preprocessing import OneHotEncoder
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from common.loss_funcions import cross_entropy_error, squared_error
+from common.activation_functions import sigmoid, relu
 from common.forward_functions import forward_middle, forward_last_classification
-from common.backward_functions import softmax_loss_backward, affine_backward_bias, affine_backward_weight, affine_backward_zprev, relu_backward, sigmoid_backward
+from common.backward_functions import softmax_loss_backward, affine_backward, relu_backward, sigmoid_backward
+from common.utils import make_rng
+from common.minibatch import EpochSampler
 
 class BackpropNeuralNet:
     def __init__(self, X: np.ndarray, T: np.ndarray, 
@@ -11,7 +15,7 @@ class BackpropNeuralNet:
                  batch_size: int, n_iter: int,
                  loss_type: str, activation_function: str,
                  learning_rate: float,
-                 weight_init_std=0.01):
+                 weight_init_std=0.01, random_state=None, log_interval=1):
         """
         ハイパーパラメータの読込＆パラメータの初期化
 
@@ -37,6 +41,10 @@ class BackpropNeuralNet:
             学習率
         weight_init_std : float
             重み初期値生成時の標準偏差
+        random_state : int, optional
+            重みの初期化とミニバッチのサンプリングに使用する乱数シード (Noneの場合はnp.random.seedで設定したグローバルな乱数に従う)
+        log_interval : int
+            学習経過 (損失関数)を記録するイテレーション間隔 (1なら毎イテレーション記録)
         """
         # 各種メンバ変数 (ハイパーパラメータ等)の入力
         self.input_size = X.shape[1]  # 説明変数の次元数(1層目の入力数)
@@ -49,11 +57,26 @@ class BackpropNeuralNet:
         self.loss_type = loss_type  # 損失関数の種類
         self.activation_function = activation_function  # 中間層活性化関数の種類
         self.weight_init_std = weight_init_std  # 重み初期値生成時の標準偏差
-        # 損失関数と活性化関数が正しく入力されているか判定
+        self.random_state = random_state  # 乱数シード
+        self._rng = make_rng(random_state)  # 乱数生成器 (重みの初期化とミニバッチのサンプリングに使用)
+        self.log_interval = log_interval  # 学習経過を記録するイテレーション間隔
+        self._sampler = EpochSampler(self._rng)  # ミニバッチのサンプリング (エポックごとにシャッフル)
+        # 損失関数・活性化関数等の引数が正しく入力されているか判定
         if loss_type not in ['cross_entropy', 'squared_error']:
             raise Exception('the `loss_type` argument should be "cross_entropy" or "squared_error"')
         if activation_function not in ['sigmoid', 'relu']:
             raise Exception('the `activation_function` argument should be "sigmoid" or "relu"')
+        if not isinstance(log_interval, (int, np.integer)) or log_interval < 1:
+            raise Exception('the `log_interval` argument should be a positive integer')
+        # 活性化関数に応じた順伝播・逆伝播の関数を事前に決定 (層ごと・イテレーションごとの分岐を省略)
+        self._forward_middle = partial(forward_middle, activation_function=activation_function, output_A=True)
+        self._activation = relu if activation_function == 'relu' else sigmoid  # 推論時の中間層の活性化関数
+        if activation_function == 'relu':
+            self._act_backward_fn = relu_backward  # Reluレイヤの逆伝播
+            self._act_cache = 'A'  # (中間結果Aを入力)
+        else:
+            self._act_backward_fn = sigmoid_backward  # Sigmoidレイヤの逆伝播
+            self._act_cache = 'Z'  # (中間層出力Zを入力)
         # パラメータを初期化
         self._initialize_parameters()
         
@@ -61,20 +84,91 @@ class BackpropNeuralNet:
         """
         パラメータを初期化
         """
-        # パラメータ格納用に空の辞書のリストを準備
-        self.params = [{} for l in range(self.n_layers)]
-        # 重みパラメータ
-        self.params[0]['W'] = self.weight_init_std \
-                            * np.random.randn(self.input_size, self.hidden_size)  # 1層目の重みパラメータ
-        for l in range(1, self.n_layers-1):
-            self.params[l]['W'] = self.weight_init_std \
-                            * np.random.randn(self.hidden_size, self.hidden_size) # 中間層の重みパラメータ
-        self.params[self.n_layers-1]['W'] = self.weight_init_std \
-                            * np.random.randn(self.hidden_size, self.output_size) # 出力層の重みパラメータ
-        # バイアスパラメータ
-        for l in range(self.n_layers-1):
-            self.params[l]['b'] = np.zeros(self.hidden_size)  # 中間層のバイアスパラメータ
-        self.params[self.n_layers-1]['b'] = np.zeros(self.output_size)  # 最終層のバイアスパラメータ
+        # 全パラメータを1本の連続した1次元配列にまとめて確保 (メモリ転送量削減のためfloat32で保持、バイアスの初期値は0)
+        n_params = sum(int(np.prod(shape)) for shape in self._stacked_shapes())
+        self._theta = np.zeros(n_params, dtype=np.float32)
+        # 重みパラメータ・バイアスパラメータは上記の配列のビューとして保持
+        self._bind_views()
+        # 重みパラメータに乱数を直接書き込んで初期化
+        for W in (self.W_in, self.W_hidden, self.W_out):
+            self._rng.standard_normal(dtype=np.float32, out=W)
+            W *= self.weight_init_std
+
+    def _bind_views(self):
+        """
+        全パラメータの1次元配列から、パラメータのビューを作成して保持
+        """
+        # (W_in: 1層目の重み、W_hidden: 中間層の重み、W_out: 出力層の重み、b_hidden: 中間層のバイアス、b_out: 最終層のバイアス)
+        self.W_in, self.W_hidden, self.W_out, self.b_hidden, self.b_out = self._split_flat(self._theta)
+        # 層ごとのパラメータ (上記の配列のビューを格納した辞書のリスト)
+        self.params = self._layer_views(self.W_in, self.W_hidden, self.W_out, self.b_hidden, self.b_out)
+        # 推論用の (重み, バイアス)のタプル (パラメータはin-placeで更新されるため、学習後も再作成不要)
+        self._hidden_params = tuple((p['W'], p['b']) for p in self.params[:-1])  # 中間層
+        self._final_params = (self.params[-1]['W'], self.params[-1]['b'])  # 出力層
+
+    def __getstate__(self):
+        """
+        pickle・deepcopy時は、パラメータのビューを除いて保存 (ビューは復元後に1次元配列から作り直す)
+        """
+        state = self.__dict__.copy()
+        for name in ('W_in', 'W_hidden', 'W_out', 'b_hidden', 'b_out', 'params',
+                     '_hidden_params', '_final_params', '_grads'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        pickle・deepcopyからの復元時に、パラメータと勾配のビューを作り直す
+        """
+        self.__dict__.update(state)
+        self._bind_views()
+        if hasattr(self, '_grad'):
+            self._grads = self._layer_views(*self._split_flat(self._grad))
+
+    def _stacked_shapes(self):
+        """
+        まとめて保持するパラメータ (W_in, W_hidden, W_out, b_hidden, b_out)の形状
+        """
+        return [(self.input_size, self.hidden_size),  # 1層目の重みパラメータ
+                (self.n_layers-2, self.hidden_size, self.hidden_size),  # 中間層の重みパラメータ (形状が共通する2層目以降をまとめる)
+                (self.hidden_size, self.output_size),  # 出力層の重みパラメータ
+                (self.n_layers-1, self.hidden_size),  # 中間層のバイアスパラメータ
+                (self.output_size,)]  # 最終層のバイアスパラメータ
+
+    def _split_flat(self, flat):
+        """
+        1次元配列を、まとめて保持するパラメータの形状のビューに分割
+        """
+        views = []
+        pos = 0
+        for shape in self._stacked_shapes():
+            size = int(np.prod(shape))
+            views.append(flat[pos:pos+size].reshape(shape))
+            pos += size
+        return tuple(views)
+
+    def _layer_views(self, W_in, W_hidden, W_out, b_hidden, b_out):
+        """
+        まとめて保持した配列から、層ごとのビューを格納した辞書のリストを作成
+        """
+        Ws = [W_in] + [W_hidden[l] for l in range(self.n_layers-2)] + [W_out]
+        bs = [b_hidden[l] for l in range(self.n_layers-1)] + [b_out]
+        return [{'W': Ws[l], 'b': bs[l]} for l in range(self.n_layers)]
+
+    def _predict_fast(self, X):
+        """
+        推論用の順伝播 (保持した (重み, バイアス)のタプルを使用し、辞書参照や分岐を省略)
+        """
+        activation = self._activation  # 中間層の活性化関数
+        Z = X
+        # 中間層の順伝播 (中間結果Aの配列上で、バイアスの加算と活性化関数をin-placeで計算)
+        for W, b in self._hidden_params:
+            A = np.dot(Z, W)
+            A += b
+            Z = activation(A, out=A)
+        # 出力層の順伝播
+        W_final, b_final = self._final_params
+        return forward_last_classification(Z, W_final, b_final)
 
     def _one_hot_encoding(self, T):
         """
@@ -82,9 +176,10 @@ class BackpropNeuralNet:
         """
         # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
         if T.ndim == 1:
-            T_onehot = T.reshape([T.size, 1])
-            self.one_hot_encoder_ = OneHotEncoder().fit(T_onehot)  # エンコーダをメンバ変数として保持
-            T_onehot = self.one_hot_encoder_.transform(T_onehot).toarray()
+            # カテゴリ一覧をメンバ変数として保持し、各データのカテゴリのインデックスを取得
+            self.categories_, T_index = np.unique(T, return_inverse=True)
+            # 単位行列から各インデックスに対応する行を取り出してOne-hot encoding
+            T_onehot = np.eye(self.categories_.size, dtype=np.float32)[T_index]
         # Tが2次元ベクトルなら既にOne-hot encodingされているとみなしてそのまま返す
         else:
             T_onehot = T
@@ -96,35 +191,43 @@ class BackpropNeuralNet:
         """
         # One-hotをクラスのインデックスに変換
         T_label = np.argmax(T, axis=1)
-        # メンバ変数として保持したエンコーダを参照にカテゴリ変数に戻す
-        T_cat = np.vectorize(lambda x: self.one_hot_encoder_.categories_[0][x])(T_label)
+        # メンバ変数として保持したカテゴリ一覧から、インデックスでまとめて取り出す
+        T_cat = self.categories_[T_label]
         return T_cat
     
     def _predict_onehot(self, X, train_flg=False):
         """
         順伝播を全て計算(One-hot encodingで出力)
         """
+        # 中間層出力が不要な場合は、構造に特化した順伝播関数で計算
+        if not train_flg:
+            return self._predict_fast(X)
+        return self._forward_train(X, *self._weight_bias_lists(self.params))
+
+    def _forward_train(self, X, Ws, bs):
+        """
+        学習用の順伝播 (各層の重み・バイアスのリストWs, bsを使用し、中間層出力も出力)
+        """
+        forward_middle_fn = self._forward_middle
         Z_current = X  # 入力値を保持
         Z_intermediate = []  # 中間層出力の保持用 (5章の誤差逆伝播法で使用)
         A_intermediate = []  # 中間層の途中結果Aの保持用 (5章の誤差逆伝播法で使用)
         # 中間層(1〜n_layers-1層目)の順伝播
         for l in range(self.n_layers-1):
-            W = self.params[l]['W']  # 重みパラメータ
-            b = self.params[l]['b']  # バイアスパラメータ
-            Z_current, A_current = forward_middle(Z_current, W, b, 
-                activation_function=self.activation_function, output_A=True)  # 中間層の計算
+            Z_current, A_current = forward_middle_fn(Z_current, Ws[l], bs[l])  # 中間層の計算
             Z_intermediate.append(Z_current)  # 中間層出力を保持 (5章の誤差逆伝播法で使用)
             A_intermediate.append(A_current)  # 中間層の途中結果Aを保持 (5章の誤差逆伝播法で使用)
         # 出力層の順伝播
-        W_final = self.params[self.n_layers-1]['W']
-        b_final = self.params[self.n_layers-1]['b']
-        Z_result = forward_last_classification(Z_current, W_final, b_final)
-        # 中間層出力も出力する場合 (5章の誤差逆伝播法で使用)
-        if train_flg:
-            return Z_result, Z_intermediate, A_intermediate
-        # 中間層出力を出力しない場合
-        else:
-            return Z_result
+        Z_result = forward_last_classification(Z_current, Ws[-1], bs[-1])
+        # 中間層出力も出力する (5章の誤差逆伝播法で使用)
+        return Z_result, Z_intermediate, A_intermediate
+
+    @staticmethod
+    def _weight_bias_lists(params):
+        """
+        層ごとの辞書のリストから、重みのリストとバイアスのリストを作成 (ループ内の辞書参照を省略するために使用)
+        """
+        return [param['W'] for param in params], [param['b'] for param in params]
     
     def predict(self, X: np.ndarray) -> np.ndarray:
         """
@@ -162,17 +265,19 @@ class BackpropNeuralNet:
         T_batch : np.ndarray
             ランダムに選択されたミニバッチの教師データ（形状：(batch_size, n_classes)）
         """
-        train_size = X.shape[0]  # サンプリング前のデータ数
-        batch_mask = np.random.choice(train_size, self.batch_size)  # ランダムサンプリング
-        X_batch = X[batch_mask]
-        T_batch = T[batch_mask]
-        return X_batch, T_batch
-
+        return self._sampler.sample((X, T), self.batch_size)
+
     def _loss(self, X, T):
         """
         損失関数の計算
         """
         Y = self._predict_onehot(X)
+        return self._loss_from_output(Y, T)
+
+    def _loss_from_output(self, Y, T):
+        """
+        計算済みの順伝播出力Yから損失関数を計算
+        """
         if self.loss_type == 'cross_entropy':
             return cross_entropy_error(Y, T)
         elif self.loss_type == 'squared_error':
@@ -196,44 +301,58 @@ class BackpropNeuralNet:
         grads : List[Dict[str, np.ndarray]]
             計算された各層の勾配をリストとして保持 (パラメータ名をキーとした辞書のリスト)
         """
+        # 逆伝播結果格納用 (全パラメータと同じ並びの1次元配列を確保し、層ごとのビューの辞書のリストに書き込む)
+        grad_flat, grads = self._allocate_grads(X, T)
+        self._backward_into(X, T, *self._weight_bias_lists(self.params), *self._weight_bias_lists(grads))
+        # まとめて確保した勾配を保持 (update_parametersでの一括更新に使用)
+        self._grads = grads
+        self._grad = grad_flat
+
+        return grads
+
+    def _allocate_grads(self, X, T):
+        """
+        全パラメータと同じ並びの勾配格納用の1次元配列と、層ごとのビューの辞書のリストを確保
+        """
+        dtype = np.result_type(X, T, self._theta)  # 入力データに合わせた勾配の型
+        grad_flat = np.empty_like(self._theta, dtype=dtype)
+        grads = self._layer_views(*self._split_flat(grad_flat))
+        return grad_flat, grads
+
+    def _backward_into(self, X, T, Ws, bs, dWs, dbs):
+        """
+        誤差逆伝播法で計算した勾配を、確保済みの勾配の配列に書き込む
+        (Ws, bs: 各層の重み・バイアスパラメータのリスト、dWs, dbs: 書き込み先の各層の勾配のリスト)
+        """
+        # ループ内で使用する属性をローカル変数に保持 (属性参照の繰り返しを省略)
+        n_layers = self.n_layers
+        act_backward_fn = self._act_backward_fn
         # 順伝播 (中間層出力Zおよび中間層の中間結果Aも保持する)
-        Y, Z_intermediate, A_intermediate = self._predict_onehot(X, train_flg=True)
-        # 逆伝播結果格納用 (空の辞書のリスト)
-        grads = [{} for l in range(self.n_layers)]
+        Y, Z_intermediate, A_intermediate = self._forward_train(X, Ws, bs)
+        self._last_Y = Y  # 損失関数の計算で再利用するため保持
+        # 活性化関数レイヤの逆伝播に入力する中間結果 (Reluは中間結果A、Sigmoidは中間層出力Z)
+        act_cache = A_intermediate if self._act_cache == 'A' else Z_intermediate
         ###### 出力層の逆伝播 ######
         # Softmax-with-Lossレイヤ
         dA = softmax_loss_backward(Y, T)
-        # Affineレイヤ
-        db = affine_backward_bias(dA)  # バイアスパラメータbの偏微分
-        dW = affine_backward_weight(dA, Z_intermediate[self.n_layers-2])  # 重みパラメータWの偏微分 (前層出力Z_prevを入力)
-        dZ_prev = affine_backward_zprev(dA, self.params[self.n_layers-1]['W'])  # 前層出力Z_prevの偏微分 (重みパラメータWを入力)
-        # 計算した偏微分(勾配)を保持
-        grads[self.n_layers-1]['b'] = db
-        grads[self.n_layers-1]['W'] = dW
+        # Affineレイヤ (重みW、バイアスb、前層出力Z_prevの偏微分をまとめて計算)
+        # (計算した偏微分(勾配)は勾配格納用の配列に直接書き込む)
+        _, _, dZ_prev = affine_backward(dA, Z_intermediate[n_layers-2], Ws[n_layers-1],
+                                        dW_out=dWs[n_layers-1], db_out=dbs[n_layers-1])
         ###### 中間層の逆伝播 (下流から順番にループ) ######
-        for l in range(self.n_layers-2, -1, -1):
-            # 当該層の出力偏微分dZを更新
-            dZ = dZ_prev.copy()
-            # Reluレイヤ
-            if self.activation_function == 'relu':
-                dA = relu_backward(dZ, A_intermediate[l])  # (中間結果Aを入力)
-            # Sigmoidレイヤ
-            if self.activation_function == 'sigmoid':
-                dA = sigmoid_backward(dZ, Z_intermediate[l])  # (中間層出力Zを入力)
+        for l in range(n_layers-2, -1, -1):
+            # 当該層の出力偏微分dZを更新 (dZ_prevは以降で書き換えないため、コピーせずそのまま参照)
+            dZ = dZ_prev
+            # 活性化関数レイヤ (Relu or Sigmoid)
+            dA = act_backward_fn(dZ, act_cache[l])
             # Affineレイヤ
-            db = affine_backward_bias(dA)  # バイアスパラメータbの偏微分
             # 初層以外の場合
             if l > 0:
-                dW = affine_backward_weight(dA, Z_intermediate[l-1])  # 重みパラメータWの偏微分 (前層出力Z_prevを入力)
-                dZ_prev = affine_backward_zprev(dA, self.params[l]['W'])  # 前層出力Z_prevの偏微分 (重みパラメータWを入力)
-            # 初層の場合
+                _, _, dZ_prev = affine_backward(dA, Z_intermediate[l-1], Ws[l],
+                                                dW_out=dWs[l], db_out=dbs[l])
+            # 初層の場合 (前層出力の偏微分は不要なので、入力データXのみ入力)
             else:
-                dW = affine_backward_weight(dA, X)  # 重みパラメータZ (入力データXを入力)
-            # 計算した偏微分(勾配)を保持
-            grads[l]['b'] = db
-            grads[l]['W'] = dW
-
-        return grads
+                affine_backward(dA, X, dW_out=dWs[l], db_out=dbs[l])
 
     def update_parameters(self, grads: List[Dict[str, np.ndarray]]):
         """
@@ -244,10 +363,23 @@ class BackpropNeuralNet:
         grads : List[Dict[str, np.ndarray]]
             各層の勾配を保持したリスト (パラメータ名をキーとした辞書のリスト)
         """
-        # パラメータの更新
-        for l in range(self.n_layers):
-            self.params[l]['W'] -= self.learning_rate * grads[l]['W']
-            self.params[l]['b'] -= self.learning_rate * grads[l]['b']
+        learning_rate = self.learning_rate
+        # gradient_backpropagationの出力であれば、全パラメータの1次元配列を1回の演算でまとめて更新
+        if grads is getattr(self, '_grads', None):
+            grad = self._grad
+            theta = self._theta
+            # 学習率を掛けた勾配は作業用の配列に書き込む (入力の勾配は書き換えず、一時配列も毎回確保しない)
+            scratch = getattr(self, '_grad_scratch', None)
+            if scratch is None or scratch.shape != grad.shape or scratch.dtype != grad.dtype:
+                scratch = np.empty_like(grad)
+                self._grad_scratch = scratch
+            np.multiply(grad, learning_rate, out=scratch)
+            np.subtract(theta, scratch, out=theta, casting='same_kind')
+        # それ以外の場合は層ごとに更新
+        else:
+            for param, grad in zip(self.params, grads):
+                param['W'] -= learning_rate * grad['W']
+                param['b'] -= learning_rate * grad['b']
     
     def fit(self, X: np.ndarray, T: np.ndarray):
         """
@@ -260,22 +392,46 @@ class BackpropNeuralNet:
         T : np.ndarray
             ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
         """
+        # 乱数生成器を作り直す (同じrandom_stateであれば、fitを繰り返しても同じ学習結果を再現)
+        self._rng = make_rng(self.random_state)
         # パラメータを初期化
         self._initialize_parameters()
+        # 2次元のT (One-hot encoding済み)で学習し直す場合、以前の学習で保持したカテゴリ一覧は対応しないため削除
+        if T.ndim == 2 and hasattr(self, 'categories_'):
+            del self.categories_
         # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
         T = self._one_hot_encoding(T)
+        # 学習はパラメータと同じfloat32で計算 (ミニバッチ取得時の行方向の読み出しが連続になるようC連続で保持)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        T = np.ascontiguousarray(T, dtype=np.float32)
+        # シャッフル済みデータを破棄し、作り直した乱数生成器に置き換え (最初のミニバッチ取得時に新しいエポックを開始)
+        self._sampler.reset(self._rng)
+        # 勾配格納用の配列を1度だけ確保し、毎イテレーション上書き (update_parametersでの一括更新に使用)
+        self._grad, self._grads = self._allocate_grads(X, T)
+        grads = self._grads
+        # 各層のパラメータと勾配のリストを1度だけ作成 (ビューのため、in-placeの更新・書き込みがそのまま反映される)
+        Ws, bs = self._weight_bias_lists(self.params)
+        dWs, dbs = self._weight_bias_lists(grads)
         # n_iter繰り返す
         self.train_loss_list = []
-        for i_iter in range(self.n_iter):
-            # ステップ1: ミニバッチの取得
-            X_batch, T_batch = self.select_minibatch(X, T)
-            # ステップ2: 勾配の計算
-            grads = self.gradient_backpropagation(X_batch, T_batch)
-            # ステップ3: パラメータの更新
-            self.update_parameters(grads)
-            # 学習経過の記録
-            loss = self._loss(X_batch, T_batch)
-            self.train_loss_list.append(loss)
+        # 次エポックのシャッフルを先読みするスレッドを起動 (学習終了時に停止)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self._sampler.executor = executor
+            try:
+                for i_iter in range(self.n_iter):
+                    # ステップ1: ミニバッチの取得
+                    X_batch, T_batch = self.select_minibatch(X, T)
+                    # ステップ2: 勾配の計算 (確保済みの配列に書き込む)
+                    self._backward_into(X_batch, T_batch, Ws, bs, dWs, dbs)
+                    # ステップ3: パラメータの更新 (全パラメータの1次元配列をまとめて更新)
+                    self.update_parameters(grads)
+                    # 学習経過の記録 (log_intervalごとに、勾配計算時の順伝播出力を再利用して計算)
+                    if i_iter % self.log_interval == 0:
+                        loss = self._loss_from_output(self._last_Y, T_batch)
+                        self.train_loss_list.append(loss)
+            finally:
+                # 先読みスレッドの参照と、学習後に不要な学習データのシャッフル済みコピー等を解放
+                self._sampler.reset()
         
     def accuracy(self, X_test: np.ndarray, T_test: np.ndarray) -> float:
         """
@@ -286,18 +442,26 @@ class BackpropNeuralNet:
         X_test : np.ndarray
             入力データとなる2D numpy配列（形状:(n_samples, n_features)）
         T_test : np.ndarray
-            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
+            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合、学習時のクラス名と直接比較される）
 
         Returns
         -------
         float
             正解率 (Accuracy)
         """
-        # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
-        T_test = self._one_hot_encoding(T_test)
         # 順伝播を計算
         Y_test = self._predict_onehot(X_test)
-        Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
-        T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
+        # Tが1次元ベクトルなら、予測をクラス名に戻して直接比較 (One-hot encodingとargmaxの往復を省略)
+        if T_test.ndim == 1 and hasattr(self, 'categories_'):
+            Y_test_label = self._one_hot_encoding_reverse(Y_test)  # 予測クラス名
+            T_test_label = T_test  # 正解クラス名
+        # 学習時のクラス名がない (2次元のTで学習した)場合は、ソート順のクラスのインデックスに変換して比較
+        elif T_test.ndim == 1:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.unique(T_test, return_inverse=True)[1]  # 正解クラス (クラス名をインデックスに変換)
+        # Tが2次元ベクトルならOne-hotをクラスのインデックスに変換して比較
+        else:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
         accuracy = np.sum(Y_test_label == T_test_label) / float(X_test.shape[0])
         return accuracy
\ No newline at end of file
@@ -1,16 +1,18 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple
-from sklearn.preprocessing import OneHotEncoder
 import copy
 
 from common.loss_funcions import cross_entropy_error, squared_error
 from common.optimizers import BaseOptimizer, SGD, Momentum, AdaGrad, RMSprop, Adam, AdamW
+from common.utils import make_rng
+from common.minibatch import EpochSampler
 
 class ConvolutionNet:
     def __init__(self, layers: List, 
                  batch_size: int, n_iter: int,
                  loss_type: str,
-                 optimizer='adam'):
+                 optimizer='adam', random_state=None, use_gpu=False, log_interval=1):
         """
         ハイパーパラメータの読込＆パラメータの初期化
 
@@ -26,6 +28,14 @@ class ConvolutionNet:
             損失関数の種類 ('cross_entropy': 交差エントロピー誤差, 'squared_error': 2乗和誤差)
         optimizer : {common.optimizers.BaseOptimizer, 'sgd', 'momentum', 'adagrad', 'rmsprop', 'adam', 'adamw'}
             最適化アルゴリズムの種類 ('sgd': SGD, 'momentum': モーメンタム, 'adagrad': AdaGrad, 'rmsprop': 'RMSProp', 'adam': Adam, 'adamw': AdamW)
+        random_state : int, optional
+            ミニバッチのサンプリングに使用する乱数シード (Noneの場合はnp.random.seedで設定したグローバルな乱数に従う。各層の重みの初期化はグローバルな乱数を使用)
+        use_gpu : bool
+            TrueのときCuPyでGPU上に学習・推論を実行 (パラメータと各ミニバッチをGPUに転送し、
+            numpyの関数呼び出しはCuPyの配列に対してGPU上の計算にディスパッチされる。
+            supports_gpu属性がTrueの層 (Dense, DenseOutput)のみ対応)
+        log_interval : int
+            学習経過 (損失関数)を記録するイテレーション間隔 (1なら毎イテレーション記録)
         """
         # 各種メンバ変数 (ハイパーパラメータ等)の入力
         self.layers = layers  # ネットワーク構造 (各層のクラスをリスト化したもの)
@@ -33,10 +43,27 @@ class ConvolutionNet:
         self.n_iter = n_iter  # 学習のイテレーション(繰り返し)数
         self.loss_type = loss_type  # 損失関数の種類
         self.optimizer = optimizer  # 最適化アルゴリズムの種類
+        self.random_state = random_state  # 乱数シード
+        self._rng = make_rng(random_state)  # 乱数生成器 (ミニバッチのサンプリングに使用)
+        self.log_interval = log_interval  # 学習経過を記録するイテレーション間隔
+        self._sampler = EpochSampler(self._rng)  # ミニバッチのサンプリング (エポックごとにシャッフル)
+        self.use_gpu = use_gpu  # GPU使用の有無
+        # 配列計算に使用するモジュール (GPU使用時はCuPy、CPU使用時はnumpy)
+        if use_gpu:
+            # 内部でnumpyの配列を生成する層 (Dropout, BatchNormalization等)はGPU上で計算できないためエラー
+            for layer in layers:
+                if not getattr(layer, 'supports_gpu', False):
+                    raise Exception(f'the `use_gpu` argument cannot be used with the {type(layer).__name__} layer')
+            import cupy
+            self.xp = cupy
+        else:
+            self.xp = np
 
-        # 損失関数が正しく入力されているか判定
+        # 損失関数と学習経過の記録間隔が正しく入力されているか判定
         if loss_type not in ['cross_entropy', 'squared_error']:
             raise Exception('the `loss_type` argument should be "cross_entropy" or "squared_error"')
+        if not isinstance(log_interval, (int, np.integer)) or log_interval < 1:
+            raise Exception('the `log_interval` argument should be a positive integer')
         # パラメータを初期化
         self._initialize_parameters()
         # 層数を計算
@@ -54,6 +81,12 @@ class ConvolutionNet:
             # 初層以外のとき、前層の出力サイズを入力サイズとして使用
             else:
                 layer.initialize_parameters(input_shape=self.layers[l-1].output_shape)
+            # GPU使用時は、パラメータをGPUに転送
+            if self.use_gpu and hasattr(layer, 'params'):
+                layer.params = {k: self.xp.asarray(v) for k, v in layer.params.items()}
+            # 中間結果のバッファを持つ層は、ミニバッチのデータ数に合わせて事前に確保
+            if hasattr(layer, 'initialize_buffers'):
+                layer.initialize_buffers(self.batch_size)
 
         # 最適化用クラスの初期化
         self._initialize_optimizers()
@@ -102,9 +135,10 @@ class ConvolutionNet:
         """
         # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
         if T.ndim == 1:
-            T_onehot = T.reshape([T.size, 1])
-            self.one_hot_encoder_ = OneHotEncoder().fit(T_onehot)  # エンコーダをメンバ変数として保持
-            T_onehot = self.one_hot_encoder_.transform(T_onehot).toarray()
+            # カテゴリ一覧をメンバ変数として保持し、各データのカテゴリのインデックスを取得
+            self.categories_, T_index = np.unique(T, return_inverse=True)
+            # 単位行列から各インデックスに対応する行を取り出してOne-hot encoding
+            T_onehot = np.eye(self.categories_.size, dtype=np.float32)[T_index]
         # Tが2次元ベクトルなら既にOne-hot encodingされているとみなしてそのまま返す
         else:
             T_onehot = T
@@ -116,15 +150,21 @@ class ConvolutionNet:
         """
         # One-hotをクラスのインデックスに変換
         T_label = np.argmax(T, axis=1)
-        # メンバ変数として保持したエンコーダを参照にカテゴリ変数に戻す
-        T_cat = np.vectorize(lambda x: self.one_hot_encoder_.categories_[0][x])(T_label)
+        # メンバ変数として保持したカテゴリ一覧から、インデックスでまとめて取り出す
+        T_cat = self.categories_[T_label]
         return T_cat
     
+    def _to_numpy(self, A):
+        """
+        GPU上の配列をnumpy配列に変換 (CPU使用時はそのまま返す)
+        """
+        return self.xp.asnumpy(A) if self.use_gpu else A
+
     def _predict_onehot(self, X, train_flg=False):
         """
         順伝播を全て計算(One-hot encodingで出力)
         """
-        Z_current = X  # 入力値を保持
+        Z_current = self.xp.asarray(X)  # 入力値を保持 (GPU使用時はGPUに転送)
         # 順伝播
         for l, layer in enumerate(self.layers):
             Z_current = layer.forward(Z_current, train_flg)
@@ -145,7 +185,7 @@ class ConvolutionNet:
         np.ndarray
             予測されたクラスラベルの1D numpy配列
         """
-        Y = self._predict_onehot(X)
+        Y = self._to_numpy(self._predict_onehot(X))
         Y = self._one_hot_encoding_reverse(Y)
         return Y
 
@@ -167,17 +207,19 @@ class ConvolutionNet:
         T_batch : np.ndarray
             ランダムに選択されたミニバッチの教師データ（形状：(batch_size, n_classes)）
         """
-        train_size = X.shape[0]  # サンプリング前のデータ数
-        batch_mask = np.random.choice(train_size, self.batch_size)  # ランダムサンプリング
-        X_batch = X[batch_mask]
-        T_batch = T[batch_mask]
-        return X_batch, T_batch
+        return self._sampler.sample((X, T), self.batch_size)
 
     def _loss(self, X, T):
         """
         損失関数の計算
         """
         Y = self._predict_onehot(X)
+        return self._loss_from_output(Y, T)
+
+    def _loss_from_output(self, Y, T):
+        """
+        計算済みの順伝播出力Yから損失関数を計算
+        """
         if self.loss_type == 'cross_entropy':
             loss = cross_entropy_error(Y, T)
         elif self.loss_type == 'squared_error':
@@ -210,6 +252,7 @@ class ConvolutionNet:
         """
         # 順伝播 (中間層出力Zおよび中間層の中間結果Aも保持する)
         Y = self._predict_onehot(X, train_flg=True)
+        self._last_Y = Y  # 損失関数の計算で再利用するため保持
         ###### 出力層の逆伝播 ######
         dZ = self.layers[self.n_layers-1].backward(Y, T)  # 逆伝播を計算
         ###### 中間層の逆伝播 (下流から順番にループ) ######
@@ -240,25 +283,46 @@ class ConvolutionNet:
         T : np.ndarray
             ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
         """
+        # 乱数生成器を作り直す (同じrandom_stateであれば、fitを繰り返しても同じ学習結果を再現)
+        self._rng = make_rng(self.random_state)
         # パラメータを初期化
         self._initialize_parameters()
+        # 2次元のT (One-hot encoding済み)で学習し直す場合、以前の学習で保持したカテゴリ一覧は対応しないため削除
+        if T.ndim == 2 and hasattr(self, 'categories_'):
+            del self.categories_
         # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
         T = self._one_hot_encoding(T)
+        # 学習はパラメータと同じfloat32で計算 (ミニバッチ取得時の行方向の読み出しが連続になるようC連続で保持)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        T = np.ascontiguousarray(T, dtype=np.float32)
+        # シャッフル済みデータを破棄し、作り直した乱数生成器に置き換え (最初のミニバッチ取得時に新しいエポックを開始)
+        self._sampler.reset(self._rng)
         # n_iter繰り返す
         self.train_loss_list = []
-        for i_iter in range(self.n_iter):
-            # ステップ1: ミニバッチの取得
-            X_batch, T_batch = self.select_minibatch(X, T)
-            # ステップ2: 勾配の計算
-            self.gradient_backpropagation(X_batch, T_batch)
-            # ステップ3: パラメータの更新
-            self.update_parameters(i_iter)
-            # 学習経過の記録
-            loss = self._loss(X_batch, T_batch)
-            self.train_loss_list.append(loss)
-            # 学習経過をプロット
-            if i_iter%10 == 0:
-                print(f'Iteration{i_iter}/{self.n_iter}')
+        # 次エポックのシャッフルを先読みするスレッドを起動 (学習終了時に停止)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self._sampler.executor = executor
+            try:
+                for i_iter in range(self.n_iter):
+                    # ステップ1: ミニバッチの取得
+                    X_batch, T_batch = self.select_minibatch(X, T)
+                    # GPU使用時は、ミニバッチをGPUに転送 (ミニバッチの取得自体はCPU上で実施)
+                    X_batch, T_batch = self.xp.asarray(X_batch), self.xp.asarray(T_batch)
+                    # ステップ2: 勾配の計算
+                    self.gradient_backpropagation(X_batch, T_batch)
+                    # ステップ3: パラメータの更新
+                    self.update_parameters(i_iter)
+                    # 学習経過の記録 (log_intervalごとに、勾配計算時の順伝播出力を再利用して計算)
+                    # (GPU使用時はfloat変換でGPUとの同期が発生するため、間隔を空けると待ち時間も削減できる)
+                    if i_iter % self.log_interval == 0:
+                        loss = self._loss_from_output(self._last_Y, T_batch)
+                        self.train_loss_list.append(float(loss))
+                    # 学習経過をプロット
+                    if i_iter%10 == 0:
+                        print(f'Iteration{i_iter}/{self.n_iter}')
+            finally:
+                # 先読みスレッドの参照と、学習後に不要な学習データのシャッフル済みコピー等を解放
+                self._sampler.reset()
         
     def accuracy(self, X_test, T_test) -> float:
         """
@@ -269,18 +333,26 @@ class ConvolutionNet:
         X_test : np.ndarray
             入力データとなる2D numpy配列（形状:(n_samples, n_features)）
         T_test : np.ndarray
-            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
+            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合、学習時のクラス名と直接比較される）
 
         Returns
         -------
         float
             正解率 (Accuracy)
         """
-        # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
-        T_test = self._one_hot_encoding(T_test)
         # 順伝播を計算
-        Y_test = self._predict_onehot(X_test)
-        Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
-        T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
+        Y_test = self._to_numpy(self._predict_onehot(X_test))
+        # Tが1次元ベクトルなら、予測をクラス名に戻して直接比較 (One-hot encodingとargmaxの往復を省略)
+        if T_test.ndim == 1 and hasattr(self, 'categories_'):
+            Y_test_label = self._one_hot_encoding_reverse(Y_test)  # 予測クラス名
+            T_test_label = T_test  # 正解クラス名
+        # 学習時のクラス名がない (2次元のTで学習した)場合は、ソート順のクラスのインデックスに変換して比較
+        elif T_test.ndim == 1:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.unique(T_test, return_inverse=True)[1]  # 正解クラス (クラス名をインデックスに変換)
+        # Tが2次元ベクトルならOne-hotをクラスのインデックスに変換して比較
+        else:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
         accuracy = np.sum(Y_test_label == T_test_label) / float(X_test.shape[0])
         return accuracy
\ No newline at end of file
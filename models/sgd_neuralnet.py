@@ -1,9 +1,12 @@
 import numpy as np
 from typing import Dict, List, Tuple
-from sklearn.preprocessing import OneHotEncoder
-import copy
-from common.loss_funcions import cross_entropy_error, squared_error
-from common.forward_functions import forward_middle, forward_last_classification
+from concurrent.futures import ThreadPoolExecutor
+from common.loss_funcions import cross_entropy_error, cross_entropy_from_logits, squared_error
+from common.activation_functions import sigmoid, relu, softmax
+from common.forward_functions import forward_middle_fast, forward_last_logits
+from common.backward_functions import softmax_loss_backward, affine_backward, relu_backward, sigmoid_backward
+from common.utils import make_rng
+from common.minibatch import EpochSampler
 
 class SGDNeuralNet:
     def __init__(self, X: np.ndarray, T: np.ndarray, 
@@ -11,7 +14,8 @@ class SGDNeuralNet:
                  batch_size: int, n_iter: int,
                  loss_type: str, activation_function: str,
                  learning_rate: float,
-                 weight_init_std=0.01):
+                 weight_init_std=0.01, gradient_method='backprop', random_state=None,
+                 n_jobs=1, log_interval=1, n_shards=1):
         """
         ハイパーパラメータの読込＆パラメータの初期化
 
@@ -37,6 +41,16 @@ class SGDNeuralNet:
             学習率
         weight_init_std : float
             重み初期値生成時の標準偏差
+        gradient_method : {'backprop', 'numerical'}
+            学習時の勾配の計算方法 ('backprop': 誤差逆伝播法, 'numerical': 数値微分)
+        random_state : int, optional
+            重みの初期化とミニバッチのサンプリングに使用する乱数シード (Noneの場合はnp.random.seedで設定したグローバルな乱数に従う)
+        n_jobs : int
+            数値微分で層・パラメータごとの勾配を並列計算するスレッド数 (1なら並列化しない、-1なら全CPUコアを使用)
+        log_interval : int
+            学習経過 (損失関数)を記録するイテレーション間隔 (1なら毎イテレーション記録)
+        n_shards : int
+            データ並列学習でミニバッチを分割する数 (分割ごとの勾配をスレッドで並列計算して集約する。1なら分割しない)
         """
         # 各種メンバ変数 (ハイパーパラメータ等)の入力
         self.input_size = X.shape[1]  # 説明変数の次元数(1層目の入力数)
@@ -49,11 +63,28 @@ class SGDNeuralNet:
         self.loss_type = loss_type  # 損失関数の種類
         self.activation_function = activation_function  # 中間層活性化関数の種類
         self.weight_init_std = weight_init_std  # 重み初期値生成時の標準偏差
-        # 損失関数と活性化関数が正しく入力されているか判定
+        self.gradient_method = gradient_method  # 勾配の計算方法
+        self.random_state = random_state  # 乱数シード
+        self._rng = make_rng(random_state)  # 乱数生成器 (重みの初期化とミニバッチのサンプリングに使用)
+        self.n_jobs = n_jobs  # 数値微分の並列スレッド数
+        self.log_interval = log_interval  # 学習経過を記録するイテレーション間隔
+        self.n_shards = n_shards  # データ並列学習でのミニバッチの分割数
+        self._executor = None  # データ並列学習で使用するスレッドプール (fit中のみ保持)
+        self._sampler = EpochSampler(self._rng)  # ミニバッチのサンプリング (エポックごとにシャッフル)
+        # 損失関数・活性化関数等の引数が正しく入力されているか判定
         if loss_type not in ['cross_entropy', 'squared_error']:
             raise Exception('the `loss_type` argument should be "cross_entropy" or "squared_error"')
         if activation_function not in ['sigmoid', 'relu']:
             raise Exception('the `activation_function` argument should be "sigmoid" or "relu"')
+        if gradient_method not in ['backprop', 'numerical']:
+            raise Exception('the `gradient_method` argument should be "backprop" or "numerical"')
+        if not isinstance(log_interval, (int, np.integer)) or log_interval < 1:
+            raise Exception('the `log_interval` argument should be a positive integer')
+        if not isinstance(n_shards, (int, np.integer)) or n_shards < 1:
+            raise Exception('the `n_shards` argument should be a positive integer')
+        # 中間層の活性化関数とその逆伝播 (順伝播・逆伝播のたびに文字列で分岐しないよう、関数を1度だけ選択して保持)
+        self._activation = relu if activation_function == 'relu' else sigmoid
+        self._activation_backward = relu_backward if activation_function == 'relu' else sigmoid_backward
         # パラメータを初期化
         self._initialize_parameters()
         
@@ -61,20 +92,71 @@ class SGDNeuralNet:
         """
         パラメータを初期化
         """
-        # パラメータ格納用に空の辞書のリストを準備
-        self.params = [{} for l in range(self.n_layers)]
-        # 重みパラメータ
-        self.params[0]['W'] = self.weight_init_std \
-                            * np.random.randn(self.input_size, self.hidden_size)  # 1層目の重みパラメータ
-        for l in range(1, self.n_layers-1):
-            self.params[l]['W'] = self.weight_init_std \
-                            * np.random.randn(self.hidden_size, self.hidden_size) # 中間層の重みパラメータ
-        self.params[self.n_layers-1]['W'] = self.weight_init_std \
-                            * np.random.randn(self.hidden_size, self.output_size) # 出力層の重みパラメータ
+        # 全パラメータを1本の連続した1次元配列にまとめて確保 (メモリ転送量削減のためfloat32で保持)
+        n_params = sum(int(np.prod(W_shape)) + int(np.prod(b_shape)) for W_shape, b_shape in self._param_shapes())
+        self._theta = np.empty(n_params, dtype=np.float32)
+        # 層ごとのパラメータは上記の配列のビューとして保持 (パラメータ名をキーとした辞書のリスト)
+        self.params = self._layer_views(self._theta)
+        # 重みパラメータ (1層目、中間層、出力層の重みに乱数を直接書き込んで初期化)
+        for l in range(self.n_layers):
+            self._rng.standard_normal(dtype=np.float32, out=self.params[l]['W'])
+            self.params[l]['W'] *= self.weight_init_std
         # バイアスパラメータ
-        for l in range(self.n_layers-1):
-            self.params[l]['b'] = np.zeros(self.hidden_size)  # 中間層のバイアスパラメータ
-        self.params[self.n_layers-1]['b'] = np.zeros(self.output_size)  # 最終層のバイアスパラメータ
+        for l in range(self.n_layers):
+            self.params[l]['b'][...] = 0  # 中間層および最終層のバイアスパラメータ
+        # 中間層の順伝播結果を格納するバッファ (ミニバッチのデータ数で1度だけ確保し、順伝播ごとに使い回す)
+        self._act_bufs = [np.empty((self.batch_size, self.hidden_size), dtype=self.params[l]['W'].dtype)
+                          for l in range(self.n_layers-1)]
+
+    def __getstate__(self):
+        """
+        pickle・deepcopy時は、パラメータのビューを除いて保存 (ビューは復元後に1次元配列から作り直す)
+        """
+        state = self.__dict__.copy()
+        for name in ('params', '_grads'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        pickle・deepcopyからの復元時に、パラメータと勾配のビューを作り直す
+        """
+        self.__dict__.update(state)
+        self.params = self._layer_views(self._theta)
+        if hasattr(self, '_grad'):
+            self._grads = self._layer_views(self._grad)
+
+    def _param_shapes(self):
+        """
+        各層の (重みパラメータ, バイアスパラメータ)の形状
+        """
+        sizes = [self.input_size] + [self.hidden_size] * (self.n_layers-1) + [self.output_size]  # 各層の入力数・出力数
+        return [((sizes[l], sizes[l+1]), (sizes[l+1],)) for l in range(self.n_layers)]
+
+    def _layer_views(self, flat):
+        """
+        全パラメータを並べた1次元配列から、層ごとのビューを格納した辞書のリストを作成
+        """
+        views = []
+        pos = 0
+        for W_shape, b_shape in self._param_shapes():
+            W_size, b_size = int(np.prod(W_shape)), int(np.prod(b_shape))
+            views.append({'W': flat[pos:pos+W_size].reshape(W_shape),
+                          'b': flat[pos+W_size:pos+W_size+b_size].reshape(b_shape)})
+            pos += W_size + b_size
+        return views
+
+    def _allocate_grads(self, X, T):
+        """
+        全パラメータと同じ並びの勾配格納用の1次元配列を確保し、層ごとのビューの辞書のリストとして返す
+        """
+        dtype = np.result_type(X, T, self._theta)  # 入力データに合わせた勾配の型
+        grad_flat = np.empty_like(self._theta, dtype=dtype)
+        grads = self._layer_views(grad_flat)
+        # update_parametersでの一括更新に使用するため保持
+        self._grads = grads
+        self._grad = grad_flat
+        return grads
 
     def _one_hot_encoding(self, T):
         """
@@ -82,40 +164,71 @@ class SGDNeuralNet:
         """
         # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
         if T.ndim == 1:
-            T_onehot = T.reshape([T.size, 1])
-            self.one_hot_encoder_ = OneHotEncoder().fit(T_onehot)  # エンコーダをメンバ変数として保持
-            T_onehot = self.one_hot_encoder_.transform(T_onehot).toarray()
+            # カテゴリ一覧をメンバ変数として保持し、各データのカテゴリのインデックスを取得
+            self.categories_, T_index = np.unique(T, return_inverse=True)
+            # 単位行列から各インデックスに対応する行を取り出してOne-hot encoding
+            T_onehot = np.eye(self.categories_.size, dtype=np.float32)[T_index]
         # Tが2次元ベクトルなら既にOne-hot encodingされているとみなしてそのまま返す
         else:
             T_onehot = T
         return T_onehot
 
+    def _prepare_targets(self, T):
+        """
+        One-hot encodingした正解データと、正解クラスのインデックスをまとめて作成 (学習前に1度だけ実行)
+        """
+        T_onehot = self._one_hot_encoding(T)
+        T_label = np.argmax(T_onehot, axis=1).astype(np.int32)  # 正解クラスのインデックス
+        return T_onehot, T_label
+
     def _one_hot_encoding_reverse(self, T):
         """
         One-hot encodingから元のカテゴリ変数に戻す
         """
         # One-hotをクラスのインデックスに変換
         T_label = np.argmax(T, axis=1)
-        # メンバ変数として保持したエンコーダを参照にカテゴリ変数に戻す
-        T_cat = np.vectorize(lambda x: self.one_hot_encoder_.categories_[0][x])(T_label)
+        # メンバ変数として保持したカテゴリ一覧から、インデックスでまとめて取り出す
+        T_cat = self.categories_[T_label]
         return T_cat
     
     def _predict_onehot(self, X):
         """
         順伝播を全て計算(One-hot encodingで出力)
         """
+        # 出力層のロジットにソフトマックス関数をin-placeで適用
+        A = self._predict_logits(X)
+        return softmax(A, out=A)
+
+    def _predict_logits(self, X, train_flg=False):
+        """
+        出力層のソフトマックス関数以外の順伝播を全て計算 (ソフトマックス関数適用前のロジットを出力)
+        """
+        # 入力をパラメータと同じ型のC連続配列に揃える (行列積で型変換やストライドアクセスが発生しないようにする。揃っていればコピーしない)
+        X = np.ascontiguousarray(X, dtype=self._theta.dtype)
         Z_current = X  # 入力値を保持
+        Z_intermediate = []  # 中間層出力の保持用 (誤差逆伝播法で使用)
+        activation = self._activation  # 中間層の活性化関数
+        # データ数がバッファと一致するときのみバッファに書き込む (predictやaccuracyで全データを入力した場合等は新たに確保)
+        use_bufs = not train_flg and X.ndim == 2 and X.shape[0] == self.batch_size
         # 中間層(1〜n_layers-1層目)の順伝播
         for l in range(self.n_layers-1):
             W = self.params[l]['W']  # 重みパラメータ
             b = self.params[l]['b']  # バイアスパラメータ
-            Z_current = forward_middle(Z_current, W, b, 
-                activation_function=self.activation_function)  # 中間層の計算
+            # 行列積の結果の配列上でバイアスの加算と活性化関数をin-placeで計算 (一時配列を作らない)
+            Z_current = forward_middle_fast(Z_current, W, b, activation, out=self._act_bufs[l] if use_bufs else None)
+            # 中間層出力を保持する場合 (誤差逆伝播法で使用。学習時はバッファを使わないため、層ごとに別の配列となる)
+            if train_flg:
+                Z_intermediate.append(Z_current)
         # 出力層の順伝播
         W_final = self.params[self.n_layers-1]['W']
         b_final = self.params[self.n_layers-1]['b']
-        Z_result = forward_last_classification(Z_current, W_final, b_final)
-        return Z_result
+        A_result = forward_last_logits(Z_current, W_final, b_final)
+        # 中間層出力も出力する場合 (誤差逆伝播法で使用)
+        if train_flg:
+            return A_result, Z_intermediate
+        # 中間層出力を出力しない場合
+        else:
+            return A_result
     
     def predict(self, X) -> np.ndarray:
         """
@@ -131,11 +244,12 @@ class SGDNeuralNet:
         np.ndarray
             予測されたクラスラベルの1D numpy配列
         """
-        Y = self._predict_onehot(X)
-        Y = self._one_hot_encoding_reverse(Y)
+        # ソフトマックス関数は大小関係を変えないため、ロジットのargmaxからクラス名に戻す (ソフトマックス関数の計算を省略)
+        A = self._predict_logits(X)
+        Y = self._one_hot_encoding_reverse(A)
         return Y
 
-    def select_minibatch(self, X: np.ndarray, T: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    def select_minibatch(self, X: np.ndarray, T: np.ndarray, T_label: np.ndarray = None) -> Tuple[np.ndarray, ...]:
         """
         ステップ1: ミニバッチの取得
 
@@ -145,6 +259,8 @@ class SGDNeuralNet:
             入力データとなる2D numpy配列（形状:(n_samples, n_features)）
         T : np.ndarray
             ターゲットラベルとなる2D numpy配列（形状:(n_samples, n_classes)）
+        T_label : np.ndarray, optional
+            正解クラスのインデックスとなる1D numpy配列（形状:(n_samples,)）
 
         Returns
         -------
@@ -152,18 +268,25 @@ class SGDNeuralNet:
             ランダムに選択されたミニバッチの入力データ（形状：(batch_size, n_features)）
         T_batch : np.ndarray
             ランダムに選択されたミニバッチの教師データ（形状：(batch_size, n_classes)）
+        T_label_batch : np.ndarray
+            ランダムに選択されたミニバッチの正解クラスのインデックス（形状：(batch_size,)、T_label指定時のみ返す）
         """
-        train_size = X.shape[0]  # サンプリング前のデータ数
-        batch_mask = np.random.choice(train_size, self.batch_size)  # ランダムサンプリング
-        X_batch = X[batch_mask]
-        T_batch = T[batch_mask]
-        return X_batch, T_batch
+        if T_label is None:
+            return self._sampler.sample((X, T), self.batch_size)
+        # T_labelも同じ並び順でシャッフルし、X, Tと同じデータのミニバッチを取り出す
+        return self._sampler.sample((X, T, T_label), self.batch_size)
 
     def _loss(self, X, T):
         """
         損失関数の計算
         """
         Y = self._predict_onehot(X)
+        return self._loss_from_output(Y, T)
+
+    def _loss_from_output(self, Y, T):
+        """
+        計算済みの順伝播出力Yから損失関数を計算 (Yが3次元の場合は先頭の軸ごとに計算)
+        """
         if self.loss_type == 'cross_entropy':
             return cross_entropy_error(Y, T)
         elif self.loss_type == 'squared_error':
@@ -171,7 +294,68 @@ class SGDNeuralNet:
         else:
             raise Exception('The `loss_type` argument should be "cross_entropy" or "squared_error"')
     
-    def _numerical_gradient(self, X, T, param_name, l):
+    def _loss_perturbed(self, Z_prev, A_l, T, param_name, l, idx, h, work=None):
+        """
+        l層目のパラメータのidx番目の成分をそれぞれ+h, -hだけ微小変化させた場合の損失関数をまとめて計算
+
+        Parameters
+        ----------
+        Z_prev : numpy.ndarray 2D
+            l層目への入力 (l-1層目までの順伝播結果)
+        A_l : numpy.ndarray 2D
+            微小変化させる前のl層目の中間結果 (Z_prev・W + b)
+        T : numpy.ndarray 2D
+            正解データ
+        param_name : {'W', 'b'}
+            微小変化させるパラメータの種類
+        l : int
+            何層目のパラメータか
+        idx : numpy.ndarray 1D
+            微小変化させる成分 (パラメータを1次元に展開した際のインデックス)
+        h : float
+            微小変化量
+        work : List[numpy.ndarray], optional
+            l層目以降の各層の順伝播結果を書き込む作業用の3次元配列のリスト (先頭の軸が2 * idx.size以上。指定しない場合は新たに確保)
+
+        Returns
+        -------
+        numpy.ndarray 1D
+            各成分を+h (偶数番目), -h (奇数番目)だけ微小変化させた場合の損失関数 (形状:(2 * idx.size,))
+        """
+        activation = self._activation  # 中間層の活性化関数
+        rows = np.arange(idx.size)
+        n_perturbed = 2 * idx.size
+        # l層目の中間結果を微小変化の数だけ並べた3次元配列 (形状:(2 * idx.size, データ数, 出力数))
+        if work is not None:
+            A = work[0][:n_perturbed]
+        else:
+            A = np.empty((n_perturbed,) + A_l.shape, dtype=np.result_type(A_l, h))
+        A[...] = A_l
+        # W[i, j]を微小変化させた場合、l層目の中間結果はj列目のみがh * Z_prev[:, i]だけ変化する (行列積の再計算は不要)
+        if param_name == 'W':
+            i_in, j_out = np.divmod(idx, A_l.shape[1])
+            delta = h * Z_prev[:, i_in].T  # 形状(idx.size, データ数)
+        # b[j]を微小変化させた場合、l層目の中間結果はj列目のみがhだけ変化する
+        else:
+            j_out = idx
+            delta = h
+        A[2*rows, :, j_out] += delta
+        A[2*rows+1, :, j_out] -= delta
+        # l層目以降の順伝播 (l層目以降の出力は先頭の軸に微小変化ごとの結果を並べた3次元配列)
+        for i in range(l, self.n_layers):
+            # l+1層目以降は行列積の結果の配列上で、バイアスの加算と活性化関数をin-placeで計算 (一時配列を作らない)
+            if i > l:
+                A = np.matmul(Z_current, self.params[i]['W'], out=work[i-l][:n_perturbed] if work is not None else None)
+                A += self.params[i]['b']
+            # 中間層の活性化関数
+            if i < self.n_layers-1:
+                Z_current = activation(A, out=A)
+            # 出力層の活性化関数
+            else:
+                Y = softmax(A, out=A)
+        return self._loss_from_output(Y, T)
+
+    def _numerical_gradient(self, X, T, param_name, l, chunk_size=128):
         """
         層ごとの勾配を計算
 
@@ -185,30 +369,38 @@ class SGDNeuralNet:
             パラメータの種類 ('W': 重みパラメータ, 'b': バイアス)
         l : int
             何層目のパラメータか
+        chunk_size : int
+            1回の順伝播でまとめて微小変化させる成分数 (メモリ使用量は概ね2 * chunk_size * データ数 * ニューロン数に比例)
         """
-        # 勾配計算対象のパラメータを抽出 (self.params更新時に一緒に更新されないようDeepCopyする)
-        P = copy.deepcopy(self.params[l][param_name])
-
-        h = 1e-4  # 原書に記載された適切な微小変化量hの値として1e-4を採用
-        P_ravel = np.ravel(P)  # Pが行列(重みパラメータ)の時、一旦ベクトルとして展開
-        grad = np.zeros_like(P_ravel)  # Pと同じ形状のベクトルor行列を生成
-
-        # パラメータごとに偏微分を計算
-        for idx in range(P_ravel.size):
-            # 微小変化量に相当するベクトル(該当パラメータに相当する成分のみh、他成分は全て0)
-            h_vector = np.eye(P_ravel.size)[idx] * h
-            # f(x+h)の計算
-            P1 = (P_ravel + h_vector).reshape(P.shape)  # 微小変換させたP
-            self.params[l][param_name] = P1  # 微小変化させたPをパラメータに反映
-            fxh1 = self._loss(X, T)  # 微小変化後の損失関数を計算
-            # f(x-h)の計算
-            P2 = (P_ravel - h_vector).reshape(P.shape)  # 微小変換させたP
-            self.params[l][param_name] = P2  # 微小変化させたPをパラメータに反映
-            fxh2 = self._loss(X, T)  # 微小変化後の損失関数を計算
+        # 勾配計算対象のパラメータを抽出
+        P = self.params[l][param_name]
+
+        # 微小変化量h (原書の1e-4はfloat32の丸め誤差に埋もれるため、パラメータがfloat32の場合は1e-3を採用)
+        h = np.float32(1e-3) if P.dtype == np.float32 else 1e-4
+        P_ravel = P.ravel()  # Pが行列(重みパラメータ)の時、一旦ベクトルとして展開 (連続配列のためコピーは発生しない)
+        grad = np.empty_like(P_ravel)  # Pと同じ形状のベクトルor行列を生成 (全成分を上書きするため初期化は不要)
+
+        # l層目への入力を計算 (l-1層目までの順伝播はパラメータの微小変化に依存しないため1回のみ計算)
+        Z_prev = X
+        for i in range(l):
+            Z_prev = forward_middle_fast(Z_prev, self.params[i]['W'], self.params[i]['b'], self._activation)
+
+        # l層目の中間結果 (パラメータの微小変化は中間結果の1列のみを変化させるため、行列積は1回のみ計算)
+        A_l = np.dot(Z_prev, self.params[l]['W'])
+        A_l += self.params[l]['b']
+
+        # l層目以降の各層の順伝播結果を書き込む作業用の配列 (1度だけ確保して全チャンクで使い回す)
+        n_perturbed = 2 * min(chunk_size, P_ravel.size)
+        work = [np.empty((n_perturbed, A_l.shape[0], self.params[i]['W'].shape[1]), dtype=np.result_type(A_l, h))
+                for i in range(l, self.n_layers)]
+
+        # chunk_size個の成分ごとに、f(x+h)とf(x-h)を1回の順伝播でまとめて計算
+        for start in range(0, P_ravel.size, chunk_size):
+            idx = np.arange(start, min(start+chunk_size, P_ravel.size))  # 微小変化させる成分
+            # 微小変化後の損失関数をまとめて計算
+            losses = self._loss_perturbed(Z_prev, A_l, T, param_name, l, idx, h, work=work)
             # 偏微分の計算
-            grad[idx] = (fxh1 - fxh2) / (2*h)
-            # 微小変化させたPを元に戻す
-            self.params[l][param_name] = P
+            grad[idx] = (losses[0::2] - losses[1::2]) / (2*h)
         
         return grad.reshape(P.shape)
 
@@ -228,14 +420,161 @@ class SGDNeuralNet:
         grads : List[Dict[str, np.ndarray]]
             計算された各層の勾配をリストとして保持 (パラメータ名をキーとした辞書のリスト)
         """
-        # 勾配格納用 (空の辞書のリスト)
-        grads = [{} for l in range(self.n_layers)]
-        # 層ごとに計算
-        for l in range(self.n_layers):
-            grads[l]['W'] = self._numerical_gradient(X, T, 'W', l)
-            grads[l]['b'] = self._numerical_gradient(X, T, 'b', l)
+        # 勾配格納用 (全パラメータと同じ並びの1次元配列のビューの辞書のリスト)
+        grads = self._allocate_grads(X, T)
+        # 計算対象の (層, パラメータ名)の組
+        tasks = [(l, param_name) for l in range(self.n_layers) for param_name in ['W', 'b']]
+        # 並列化しない場合は、層ごとに計算
+        if self.n_jobs == 1:
+            for l, param_name in tasks:
+                grads[l][param_name][...] = self._numerical_gradient(X, T, param_name, l)
+        # 並列化する場合は、(層, パラメータ名)ごとにスレッドで並列計算
+        # (_numerical_gradientはself.paramsを書き換えないため、各スレッドで同じパラメータを参照しても競合しない。
+        #  行列積等の計算中はGILが解放されるため、スレッドでも並列に実行される)
+        else:
+            max_workers = None if self.n_jobs == -1 else self.n_jobs  # Noneの場合はCPUコア数に応じて自動設定
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(lambda task: self._numerical_gradient(X, T, task[1], task[0]), tasks)
+                for (l, param_name), grad in zip(tasks, results):
+                    grads[l][param_name][...] = grad
+        return grads
+
+    def _backward(self, X: np.ndarray, T: np.ndarray, T_label: np.ndarray = None) -> List[Dict[str, np.ndarray]]:
+        """
+        ステップ2: 誤差逆伝播法で全パラメータの勾配を計算 (numerical_gradient_allと同じ形式で出力)
+
+        Parameters
+        ----------
+        X : np.ndarray
+            入力データとなる2D numpy配列（形状:(n_samples, n_features)）
+        T : np.ndarray
+            ターゲットラベルとなる2D numpy配列（形状:(n_samples, n_classes)）
+        T_label : np.ndarray, optional
+            正解クラスのインデックスとなる1D numpy配列（形状:(n_samples,)、指定するとSoftmax-with-Lossレイヤの逆伝播に使用）
+
+        Returns
+        -------
+        grads : List[Dict[str, np.ndarray]]
+            計算された各層の勾配をリストとして保持 (パラメータ名をキーとした辞書のリスト)
+        """
+        # 勾配格納用 (全パラメータと同じ並びの1次元配列のビューの辞書のリスト)
+        grads = self._allocate_grads(X, T)
+        # 勾配を計算し、損失関数を保持 (学習経過の記録で再利用)
+        self._last_loss = self._backward_into(X, T, T_label, grads)
         return grads
 
+    def _backward_into(self, X, T, T_label, grads):
+        """
+        誤差逆伝播法で計算した勾配をgradsに書き込み、順伝播時の損失関数を返す (selfの状態を変更しないためスレッドから並列に呼び出せる)
+        """
+        # 順伝播 (ソフトマックス関数適用前のロジットを出力し、中間層出力Zも保持する)
+        A, Z_intermediate = self._predict_logits(X, train_flg=True)
+        # 交差エントロピー誤差で正解クラスのインデックスがあれば、損失関数をロジットから直接計算
+        if self.loss_type == 'cross_entropy' and T_label is not None:
+            loss = cross_entropy_from_logits(A, T_label)
+            Y = softmax(A, out=A)
+        # それ以外の場合は、ソフトマックス関数の出力から損失関数を計算 (順伝播出力Yは逆伝播で上書きされるため先に計算)
+        else:
+            Y = softmax(A, out=A)
+            loss = self._loss_from_output(Y, T)
+        ###### 出力層の逆伝播 ######
+        # Softmax-with-Lossレイヤ
+        if self.loss_type == 'cross_entropy':
+            # 正解クラスのインデックスがあれば、順伝播出力Yの正解クラスの成分のみから1を引く (Y - Tと同値)
+            if T_label is not None:
+                dA = Y  # 順伝播出力Yは以降で使用しないため、そのまま上書き
+                dA[np.arange(T_label.size), T_label] -= 1
+                dA /= T_label.size
+            else:
+                dA = softmax_loss_backward(Y, T)
+        # 2乗和誤差の場合は、損失関数の偏微分をソフトマックス関数のヤコビ行列で逆伝播
+        else:
+            dY = (Y - T) / T.shape[0]
+            dA = Y * (dY - np.sum(dY * Y, axis=1, keepdims=True))
+        # 前層 (初層の場合は入力データX)の出力
+        Z_prevs = [X] + Z_intermediate
+        activation_backward = self._activation_backward  # 中間層の活性化関数の逆伝播
+        ###### 全層の逆伝播 (下流から順番にループ) ######
+        for l in range(self.n_layers-1, -1, -1):
+            # Affineレイヤ (初層の場合、前層出力の偏微分は不要なので重みWを入力しない)
+            # (計算した偏微分(勾配)は勾配格納用の配列に直接書き込む)
+            W = self.params[l]['W'] if l > 0 else None
+            _, _, dZ_prev = affine_backward(dA, Z_prevs[l], W, dW_out=grads[l]['W'], db_out=grads[l]['b'])
+            # 前層の活性化関数レイヤ (中間層出力Zを入力。ReLUはA ≦ 0とZ ≦ 0が同値のため、中間結果Aの代わりにZを使用できる)
+            if l > 0:
+                dA = activation_backward(dZ_prev, Z_intermediate[l-1])
+        return loss
+
+    def _data_parallel_gradient(self, X: np.ndarray, T: np.ndarray, T_label: np.ndarray = None,
+                                buffers=None) -> List[Dict[str, np.ndarray]]:
+        """
+        ステップ2 (データ並列): ミニバッチをn_shards個に分割し、分割ごとの勾配をスレッドで並列計算して集約
+
+        Parameters
+        ----------
+        X : np.ndarray
+            入力データとなる2D numpy配列（形状:(n_samples, n_features)）
+        T : np.ndarray
+            ターゲットラベルとなる2D numpy配列（形状:(n_samples, n_classes)）
+        T_label : np.ndarray, optional
+            正解クラスのインデックスとなる1D numpy配列（形状:(n_samples,)）
+        buffers : tuple, optional
+            _allocate_shard_buffersで確保した勾配格納用の配列 (指定しない場合は新たに確保)
+
+        Returns
+        -------
+        grads : List[Dict[str, np.ndarray]]
+            計算された各層の勾配をリストとして保持 (パラメータ名をキーとした辞書のリスト)
+        """
+        # 勾配格納用 (集約結果と分割ごとの、全パラメータと同じ並びの1次元配列およびビューの辞書のリスト)
+        if buffers is None:
+            buffers = self._allocate_shard_buffers(X, T)
+        grad_flat, grads, shard_bufs = buffers
+        # 分割の境界 (データ数がn_shards未満の場合は分割数を減らす)
+        n_samples = X.shape[0]
+        n_shards = min(self.n_shards, n_samples)
+        bounds = np.linspace(0, n_samples, n_shards + 1).astype(int)
+
+        def shard_gradient(k):
+            # 分割ごとの勾配 (分割ごとの損失関数はデータ数で平均されているため、データ数の比率で重み付け)
+            X_shard, T_shard = X[bounds[k]:bounds[k+1]], T[bounds[k]:bounds[k+1]]
+            weight = grad_flat.dtype.type((bounds[k+1] - bounds[k]) / n_samples)
+            shard_flat, shard_grads = shard_bufs[k]
+            if self.gradient_method == 'backprop':
+                T_label_shard = T_label[bounds[k]:bounds[k+1]] if T_label is not None else None
+                loss = self._backward_into(X_shard, T_shard, T_label_shard, shard_grads)
+            else:
+                for l in range(self.n_layers):
+                    for param_name in ['W', 'b']:
+                        shard_grads[l][param_name][...] = self._numerical_gradient(X_shard, T_shard, param_name, l)
+                loss = None
+            shard_flat *= weight
+            return shard_flat, loss if loss is None else loss * weight
+
+        # 分割ごとの勾配をスレッドで並列計算 (行列積等の計算中はGILが解放されるため、スレッドでも並列に実行される)
+        # (fit外で呼び出された場合は、スレッドプールがないため順番に計算)
+        mapper = self._executor.map if self._executor is not None else map
+        results = list(mapper(shard_gradient, range(n_shards)))
+        # 分割ごとの勾配を合計 (All-reduce)
+        grad_flat[...] = results[0][0]
+        for shard_flat, _ in results[1:]:
+            grad_flat += shard_flat
+        # 誤差逆伝播法の場合は、損失関数も合計して保持 (学習経過の記録で再利用)
+        if self.gradient_method == 'backprop':
+            self._last_loss = sum(loss for _, loss in results)
+        return grads
+
+    def _allocate_shard_buffers(self, X, T):
+        """
+        データ並列学習の勾配格納用の配列 (集約結果と、分割ごとの1次元配列およびビューの辞書のリスト)を確保
+        """
+        grads = self._allocate_grads(X, T)
+        shard_bufs = []
+        for _ in range(self.n_shards):
+            shard_flat = np.empty_like(self._grad)
+            shard_bufs.append((shard_flat, self._layer_views(shard_flat)))
+        return self._grad, grads, shard_bufs
+
     def update_parameters(self, grads: List[Dict[str, np.ndarray]]):
         """
         ステップ3: パラメータの更新
@@ -245,10 +584,21 @@ class SGDNeuralNet:
         grads : List[Dict[str, np.ndarray]]
             各層の勾配を保持したリスト (パラメータ名をキーとした辞書のリスト)
         """
-        # パラメータの更新
-        for l in range(self.n_layers):
-            self.params[l]['W'] -= self.learning_rate * grads[l]['W']
-            self.params[l]['b'] -= self.learning_rate * grads[l]['b']
+        # 勾配計算メソッドの出力であれば、全パラメータの1次元配列を1回の演算でまとめて更新
+        if grads is getattr(self, '_grads', None):
+            grad = self._grad
+            # 学習率を掛けた勾配は作業用の配列に書き込む (入力の勾配は書き換えず、一時配列も毎回確保しない)
+            scratch = getattr(self, '_grad_scratch', None)
+            if scratch is None or scratch.shape != grad.shape or scratch.dtype != grad.dtype:
+                scratch = np.empty_like(grad)
+                self._grad_scratch = scratch
+            np.multiply(grad, self.learning_rate, out=scratch)
+            np.subtract(self._theta, scratch, out=self._theta, casting='same_kind')
+        # それ以外の場合は層ごとに更新
+        else:
+            for l in range(self.n_layers):
+                self.params[l]['W'] -= self.learning_rate * grads[l]['W']
+                self.params[l]['b'] -= self.learning_rate * grads[l]['b']
     
     def fit(self, X: np.ndarray, T: np.ndarray):
         """
@@ -261,22 +611,67 @@ class SGDNeuralNet:
         T : np.ndarray
             ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
         """
+        # 乱数生成器を作り直す (同じrandom_stateであれば、fitを繰り返しても同じ学習結果を再現)
+        self._rng = make_rng(self.random_state)
         # パラメータを初期化
         self._initialize_parameters()
-        # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
-        T = self._one_hot_encoding(T)
+        # 2次元のT (One-hot encoding済み)で学習し直す場合、以前の学習で保持したカテゴリ一覧は対応しないため削除
+        if T.ndim == 2 and hasattr(self, 'categories_'):
+            del self.categories_
+        # Tが1次元ベクトルなら2次元に変換してOne-hot encodingし、正解クラスのインデックスも保持
+        T, self.T_label_ = self._prepare_targets(T)
+        # 学習はパラメータと同じfloat32で計算
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        T = np.ascontiguousarray(T, dtype=np.float32)
+        # シャッフル済みデータを破棄し、作り直した乱数生成器に置き換え (最初のミニバッチ取得時に新しいエポックを開始)
+        self._sampler.reset(self._rng)
         # n_iter繰り返す
         self.train_loss_list = []
-        for i_iter in range(self.n_iter):
-            # ステップ1: ミニバッチの取得
-            X_batch, T_batch = self.select_minibatch(X, T)
-            # ステップ2: 勾配の計算
-            grads = self.numerical_gradient_all(X_batch, T_batch)
-            # ステップ3: パラメータの更新
-            self.update_parameters(grads)
-            # 学習経過の記録
-            loss = self._loss(X_batch, T_batch)
-            self.train_loss_list.append(loss)
+        # ループ内で毎回参照するメソッドや属性をローカル変数に束縛 (属性参照や勾配計算方法の分岐をループの外で1度だけ実行)
+        select_minibatch = self.select_minibatch
+        update_parameters = self.update_parameters
+        T_label = self.T_label_
+        log_interval = self.log_interval
+        train_loss_list = self.train_loss_list
+        is_backprop = self.gradient_method == 'backprop'
+        # ステップ2で使用する勾配の計算関数 (数値微分は勾配の検証用。通常は誤差逆伝播法で計算)
+        if self.n_shards > 1:
+            # データ並列学習の場合も、勾配格納用の配列を1度だけ確保して毎イテレーション上書き
+            shard_buffers = self._allocate_shard_buffers(X, T)
+            data_parallel_gradient = self._data_parallel_gradient
+            def compute_grads(X_batch, T_batch, T_label_batch=None):
+                return data_parallel_gradient(X_batch, T_batch, T_label_batch, buffers=shard_buffers)
+        elif is_backprop:
+            # 誤差逆伝播法の場合は、勾配格納用の配列を1度だけ確保して毎イテレーション上書き
+            grads = self._allocate_grads(X, T)
+            backward_into = self._backward_into
+            def compute_grads(X_batch, T_batch, T_label_batch=None):
+                self._last_loss = backward_into(X_batch, T_batch, T_label_batch, grads)
+                return grads
+        else:
+            def compute_grads(X_batch, T_batch, T_label_batch=None):
+                return self.numerical_gradient_all(X_batch, T_batch)
+        # データ並列学習用のスレッドプール (fit中は同じスレッドを使い回す)
+        with ThreadPoolExecutor(max_workers=self.n_shards) as executor:
+            self._executor = executor
+            self._sampler.executor = executor  # 次エポックのシャッフルも同じスレッドプールで先読み
+            try:
+                for i_iter in range(self.n_iter):
+                    # ステップ1: ミニバッチの取得
+                    # (T_labelがある場合は、正解クラスのインデックスのミニバッチも合わせて取得)
+                    minibatch = select_minibatch(X, T, T_label)
+                    # ステップ2: 勾配の計算
+                    batch_grads = compute_grads(*minibatch)
+                    # 学習経過の記録 (log_intervalごとに記録。勾配の計算方法によらず、パラメータ更新前の損失関数を記録)
+                    # (誤差逆伝播法の場合は勾配計算時の順伝播で計算した損失関数を再利用)
+                    if i_iter % log_interval == 0:
+                        train_loss_list.append(self._last_loss if is_backprop else self._loss(minibatch[0], minibatch[1]))
+                    # ステップ3: パラメータの更新
+                    update_parameters(batch_grads)
+            finally:
+                self._executor = None
+                # 先読みスレッドの参照と、学習後に不要な学習データのシャッフル済みコピー等を解放
+                self._sampler.reset()
         
     def accuracy(self, X_test, T_test) -> float:
         """
@@ -287,18 +682,26 @@ class SGDNeuralNet:
         X_test : np.ndarray
             入力データとなる2D numpy配列（形状:(n_samples, n_features)）
         T_test : np.ndarray
-            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合One-hot encodingで自動変換される）
+            ターゲットラベルとなる1D or 2D numpy配列（1次元ベクトルの場合、学習時のクラス名と直接比較される）
 
         Returns
         -------
         float
             正解率 (Accuracy)
         """
-        # Tが1次元ベクトルなら2次元に変換してOne-hot encodingする
-        T_test = self._one_hot_encoding(T_test)
-        # 順伝播を計算
-        Y_test = self._predict_onehot(X_test)
-        Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
-        T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
+        # 順伝播を計算 (argmaxのみ使用するため、ソフトマックス関数適用前のロジットを出力)
+        Y_test = self._predict_logits(X_test)
+        # Tが1次元ベクトルなら、予測をクラス名に戻して直接比較 (One-hot encodingとargmaxの往復を省略)
+        if T_test.ndim == 1 and hasattr(self, 'categories_'):
+            Y_test_label = self._one_hot_encoding_reverse(Y_test)  # 予測クラス名
+            T_test_label = T_test  # 正解クラス名
+        # 学習時のクラス名がない (2次元のTで学習した)場合は、ソート順のクラスのインデックスに変換して比較
+        elif T_test.ndim == 1:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.unique(T_test, return_inverse=True)[1]  # 正解クラス (クラス名をインデックスに変換)
+        # Tが2次元ベクトルならOne-hotをクラスのインデックスに変換して比較
+        else:
+            Y_test_label = np.argmax(Y_test, axis=1)  # 予測クラス (One-hotをクラスのインデックスに変換)
+            T_test_label = np.argmax(T_test, axis=1)  # 正解クラス (One-hotをクラスのインデックスに変換)
         accuracy = np.sum(Y_test_label == T_test_label) / float(X_test.shape[0])
         return accuracy
\ No newline at end of file